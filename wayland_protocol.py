@@ -1,15 +1,40 @@
 import struct
+from io import BytesIO
 
 from python_wayland.wayland import protocol as wayland
 from python_wayland.wayland.protocol import DuplicateInterfaceName
 
+_U_i = struct.Struct('i').unpack_from
+_U_I = struct.Struct('I').unpack_from
+_U_II = struct.Struct('II').unpack_from
+
+def _array_from(buf, offset):
+	# uint32 length followed by the payload padded to 4 bytes
+	length = _U_I(buf, offset)[0]
+	offset += 4
+	return buf[offset:offset + length], offset + ((length + 3) & ~3)
+
+def _string_from(buf, offset):
+	# Like an array but the length includes the terminating NUL
+	length = _U_I(buf, offset)[0]
+	if length == 0:
+		return None, offset + 4
+	offset += 4
+	return buf[offset:offset + length - 1].decode('utf-8'), offset + ((length + 3) & ~3)
+
+def _unmarshal_from(self, buf, offset, fd_source):
+	# Fallback for arg types which really need a stream, e.g. fd
+	argdata = BytesIO(buf)
+	argdata.seek(offset)
+	value = self.unmarshal(argdata, fd_source)
+	return value, argdata.tell()
+
 class WaylandInterface(wayland.Interface):
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.requests_by_name = self.requests;
-		self.requests_by_number = list()
-		for item in self.requests_by_name.values():
-			self.requests_by_number.append(item)
+		self.requests_by_number = tuple(self.requests_by_name.values())
+		self.events_by_number = tuple(self.events_by_number)
 
 class Arg_new_id(wayland.Arg_new_id):
 	def __init__(self, parent, arg):
@@ -22,38 +47,76 @@ class Arg_new_id(wayland.Arg_new_id):
 	def unmarshal(self, argdata, fd_source):
 		if self.interface:
 			# interface specified in xml
-			return struct.unpack('I', argdata.read(4))[0]
+			return _U_I(argdata.read(4), 0)[0]
 		# interface specified by caller
 		interface = wayland.Arg_string.unmarshal(None, argdata, fd_source)
-		version, new_id = struct.unpack('II', argdata.read(8))
+		version, new_id = _U_II(argdata.read(8), 0)
 		return interface, version, new_id
 
+	def unmarshal_from(self, buf, offset, fd_source):
+		if self.interface:
+			return _U_I(buf, offset)[0], offset + 4
+		interface, offset = _string_from(buf, offset)
+		version, new_id = _U_II(buf, offset)
+		return (interface, version, new_id), offset + 8
+
 class Arg_object(wayland.Arg_object):
 	def unmarshal(self, argdata, fd_source):
-		oid = struct.unpack('I', argdata.read(4))[0]
+		oid = _U_I(argdata.read(4), 0)[0]
 		return oid
 
+	def unmarshal_from(self, buf, offset, fd_source):
+		return _U_I(buf, offset)[0], offset + 4
+
+class Arg_int(wayland.Arg_int):
+	def unmarshal_from(self, buf, offset, fd_source):
+		return _U_i(buf, offset)[0], offset + 4
+
+class Arg_uint(wayland.Arg_uint):
+	def unmarshal_from(self, buf, offset, fd_source):
+		return _U_I(buf, offset)[0], offset + 4
+
+class Arg_fixed(wayland.Arg_fixed):
+	def unmarshal_from(self, buf, offset, fd_source):
+		# signed 24.8
+		m = _U_i(buf, offset)[0]
+		return float(m >> 8) + ((m & 0xff) / 256.0), offset + 4
+
+class Arg_string(wayland.Arg_string):
+	def unmarshal_from(self, buf, offset, fd_source):
+		return _string_from(buf, offset)
+
+class Arg_array(wayland.Arg_array):
+	def unmarshal_from(self, buf, offset, fd_source):
+		return _array_from(buf, offset)
+
+
+_OPS = {
+	'<<': int.__lshift__,
+	'>>': int.__rshift__,
+	 '&': int.__and__,
+	 '|': int.__or__
+}
 
 class Entry(wayland.Entry):
 	def __init__(self, enum, entry):
 		val = entry.get('value')
 		args = val.split()
 		if len(args) == 3:
-			ops = {
-				'<<': '__lshift__',
-				'>>': '__rshift__',
-				 '&': '__and__',
-				 '|': '__or__'
-			}
-			conv = ops.get(args[1])
-			func = getattr(int, conv)
+			func = _OPS.get(args[1])
 			if func:
 				calc_val = func(int(args[0], base=0), int(args[2], base=0))
 				entry.set('value', str(calc_val))
 		super().__init__(enum, entry)
 
+wayland.Arg.unmarshal_from = _unmarshal_from
 wayland.Arg_new_id = Arg_new_id
 wayland.Arg_object = Arg_object
+wayland.Arg_int = Arg_int
+wayland.Arg_uint = Arg_uint
+wayland.Arg_fixed = Arg_fixed
+wayland.Arg_string = Arg_string
+wayland.Arg_array = Arg_array
 wayland.Entry = Entry
 wayland.Interface = WaylandInterface
 
@@ -73,6 +73,9 @@
 	to not be mixed with the output of the parser. In case of live parsing just
 	redirect stderr of wayland_proxy.py to /dev/null or some file.
 
+	If stdout itself is redirected to /dev/null relayed data and disconnect
+	headers are not written out at all, the proxy then only relays.
+
 	I quickly hacked this together to aid in debugging wayland protocol
 	implementations but a proxy like this could also be used for injecting new
 	protocols into clients without the need to deep dive into frameworks like
@@ -109,27 +112,41 @@
 	You will need to make sure that the current MAX_RELAY_SIZE setting will fit into
 	the remaining bits.
 
-	You can also increase MAX_RELAY_SIZE (how many bytes we try to read/send at once
-	from/to a socket). Setting this to a large number may increase latency if there
-	is constant and fast traffic between a different server-client proxy connection.
+	MAX_RELAY_SIZE (how many bytes we try to read/send at once from/to a socket)
+	defaults to 16383 ((2**14) - 1) so a single recvmsg() call moves as much data as
+	the size field allows. As every ready socket is read only once per epoll cycle,
+	lowering it may decrease latency if there is constant and fast traffic between
+	a different server-client proxy connection.
 	Do not set this above 16383 ((2**14) - 1) without also decreasing MAX_PROXY_CONNECTIONS.
 
+	SOCKET_BUFFER_SIZE is requested as SO_RCVBUF and SO_SNDBUF for all proxied
+	sockets. The kernel silently caps it at net.core.rmem_max / net.core.wmem_max.
+
+	Sockets are multiplexed via epoll. Relay sockets are level triggered and get
+	a single recvmsg() per epoll_wait() so a busy connection can't starve the
+	others. io_uring would allow batching recvmsg / sendmsg submissions as well
+	but there is no binding for it in the Python standard library and the proxy
+	is meant to run without any dependencies other than a Python 3 interpreter.
+
 """
 
-MAX_RELAY_SIZE = 2048           # 2 ** 11
+MAX_RELAY_SIZE = 16383          # (2 ** 14) - 1
 MAX_PROXY_CONNECTIONS = 131072  # 2 ** 17
+SOCKET_BUFFER_SIZE = 1048576    # 2 ** 20
 REUSE_CONNECTION_IDS = False
 
 import os
 import sys
+import stat
 import array
 import socket
 import struct
 import shutil
 import traceback
 from math import log2
+from collections import deque
 from subprocess import Popen
-from select import poll, POLLIN, POLLPRI
+from select import epoll, EPOLLIN, EPOLLPRI
 
 (
 	LOG_LEVEL_DEBUG,
@@ -173,21 +190,62 @@ def log_warning(msg):
 def log_error(msg):
 	return _log(LOG_LEVEL_ERROR, msg)
 
+# Turn disabled log levels into no-ops so they don't even reach _log()
+if LOG_LEVEL_MIN > LOG_LEVEL_DEBUG:
+	log_debug = lambda msg: None
+if LOG_LEVEL_MIN > LOG_LEVEL_INFO:
+	log_info = lambda msg: None
+if LOG_LEVEL_MIN > LOG_LEVEL_WARNING:
+	log_warn = log_warning = lambda msg: None
+
+FD_SIZE = array.array('i').itemsize
+FD_ANCDATA_SIZE = socket.CMSG_SPACE(16 * FD_SIZE)
+NO_FDS = ()
+
 def msg_receive(connection):
-	fds = array.array('i')
 	data, ancdata, msg_flags, address = connection.recvmsg(
-		MAX_RELAY_SIZE, socket.CMSG_SPACE(16 * fds.itemsize)
+		MAX_RELAY_SIZE, FD_ANCDATA_SIZE, socket.MSG_DONTWAIT
 	)
+	if not ancdata:
+		# Most messages don't carry any fds
+		return data, NO_FDS
+	fds = array.array('i')
 	for cmsg_level, cmsg_type, cmsg_data in ancdata:
 		if (
 			cmsg_level == socket.SOL_SOCKET and
 			cmsg_type == socket.SCM_RIGHTS
 		):
-			fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+			fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % FD_SIZE)])
 	return data, fds
 
 def msg_send(data, fds, connection):
-	connection.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+	if not fds:
+		connection.sendmsg((data,))
+		return
+	connection.sendmsg((data,), ((socket.SOL_SOCKET, socket.SCM_RIGHTS, fds),))
+
+_HDR = struct.Struct('=I')
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+STDOUT_FILENO = sys.stdout.fileno()
+
+def is_devnull(fd):
+	st = os.fstat(fd)
+	return stat.S_ISCHR(st.st_mode) and st.st_rdev == os.stat(os.devnull).st_rdev
+
+def writev_all(fd, iov):
+	# Writes all buffers in iov and clears it. Unlike a plain os.writev()
+	# this handles more than IOV_MAX buffers as well as partial writes.
+	try:
+		i = 0
+		while i < len(iov):
+			written = os.writev(fd, iov[i:i + IOV_MAX])
+			while i < len(iov) and written >= len(iov[i]):
+				written -= len(iov[i])
+				i += 1
+			if written:
+				iov[i] = memoryview(iov[i])[written:]
+	finally:
+		iov.clear()
 
 SIZE_LEFT_SHIFT = int(log2(MAX_PROXY_CONNECTIONS * 2))
 if __name__ == '__main__':
@@ -223,15 +281,21 @@ if __name__ == '__main__':
 
 	child_proc = None
 	proxy_connections = dict()
+	stdout_iov = list()
+	# Nobody is going to read the relayed data, don't bother queuing it
+	discard_output = is_devnull(STDOUT_FILENO)
 	if REUSE_CONNECTION_IDS:
-		connection_ids_active = set()
+		# Unused connection ids other than global_connection_id, which is
+		# always the one used next. Released ids are queued at the end so
+		# they don't get reused right away.
+		connection_ids_free = deque(range(1, MAX_PROXY_CONNECTIONS))
 	try:
-		poll = poll()
+		ep = epoll()
 
 		wayland_proxy_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0)
 		wayland_proxy_socket.bind(wayland_proxy_addr)
 		wayland_proxy_socket.listen()
-		poll.register(wayland_proxy_socket, POLLIN | POLLPRI)
+		ep.register(wayland_proxy_socket.fileno(), EPOLLIN | EPOLLPRI)
 
 		log_debug(f"Starting subprocess {' '.join(sys.argv[1:])}")
 		try:
@@ -246,27 +310,35 @@ if __name__ == '__main__':
 		pidfd_open = getattr(os, 'pidfd_open')
 		if pidfd_open:
 			pid_fd = pidfd_open(child_proc.pid)
-			poll.register(pid_fd, POLLIN)
+			ep.register(pid_fd, EPOLLIN)
 
 		# Send magic for the parser to detect endianess
-		sys.stdout.buffer.write(struct.pack('=I', ENDIAN_MAGIC))
+		stdout_iov.append(_HDR.pack(ENDIAN_MAGIC))
 
 		# Send on disk format config
-		sys.stdout.buffer.write(struct.pack('=HH', DISK_FORMAT, SIZE_LEFT_SHIFT))
+		stdout_iov.append(struct.pack('=HH', DISK_FORMAT, SIZE_LEFT_SHIFT))
+		writev_all(STDOUT_FILENO, stdout_iov)
 
 		global_connection_id = 0
 		# Start relaying stuff
+		should_exit = False
 		while True:
-			for fd, events in poll.poll():
+			# Output of the previous epoll cycle is written at once
+			# right before waiting for new events
+			if stdout_iov:
+				writev_all(STDOUT_FILENO, stdout_iov)
+			events = ep.poll()
+			for fd, event in events:
 				if fd == pid_fd:
 					# Subprocess died
 					log_info("Subprocess died")
 					log_debug("Subprocess starts to think about human meat")
-					poll.unregister(fd)
+					ep.unregister(fd)
 					os.close(fd)
 					if len(proxy_connections) == 0:
-						poll.unregister(wayland_proxy_socket)
+						ep.unregister(wayland_proxy_socket.fileno())
 						wayland_proxy_socket.close()
+						should_exit = True
 						break
 					continue
 				elif fd == wayland_proxy_socket.fileno():
@@ -289,82 +361,96 @@ if __name__ == '__main__':
 					connection_id = global_connection_id
 					global_connection_id += 1
 
-					proxy_connections[wayland_client_connection.fileno()] = (IS_CLIENT, connection_id, wayland_server_connection)
-					proxy_connections[wayland_server_connection.fileno()] = (IS_SERVER, connection_id, wayland_client_connection)
-					poll.register(wayland_client_connection, POLLIN | POLLPRI)
-					poll.register(wayland_server_connection, POLLIN | POLLPRI)
+					for sock in (wayland_client_connection, wayland_server_connection):
+						sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+						sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
+					for kind, sock, peer in (
+						(IS_CLIENT, wayland_client_connection, wayland_server_connection),
+						(IS_SERVER, wayland_server_connection, wayland_client_connection)
+					):
+						# The lower bits of the output header are fixed per socket,
+						# a header with size 0 signals the disconnect
+						hdr_tag = (connection_id << 1) | kind
+						proxy_connections[sock.fileno()] = (kind, connection_id, peer, hdr_tag, _HDR.pack(hdr_tag))
+					ep.register(wayland_client_connection.fileno(), EPOLLIN | EPOLLPRI)
+					ep.register(wayland_server_connection.fileno(), EPOLLIN | EPOLLPRI)
 
 					if REUSE_CONNECTION_IDS:
-						connection_ids_active.add(connection_id)
-						log_debug(f"Current active connections {len(connection_ids_active)}/{MAX_PROXY_CONNECTIONS}")
-						if len(connection_ids_active) == MAX_PROXY_CONNECTIONS:
+						log_debug(f"Current active connections {len(proxy_connections) // 2}/{MAX_PROXY_CONNECTIONS}")
+						if not connection_ids_free:
 							global_connection_id = MAX_PROXY_CONNECTIONS
 							# TODO: eventually reopen wayland_proxy_socket on disconnect
 						else:
-							global_connection_id %= MAX_PROXY_CONNECTIONS
-							while global_connection_id in connection_ids_active:
-								global_connection_id += 1
-								global_connection_id %= MAX_PROXY_CONNECTIONS
+							global_connection_id = connection_ids_free.popleft()
 							log_debug(f"Using {global_connection_id} as next connection id")
 
 					if global_connection_id == MAX_PROXY_CONNECTIONS:
 						log_warn("Out of connections. Closing proxy socket.")
-						poll.unregister(wayland_proxy_socket)
+						ep.unregister(wayland_proxy_socket.fileno())
 						wayland_proxy_socket.close()
 
 					continue
 
 				remote = proxy_connections.get(fd, None)
 				if remote is None:
-					log_error(f"Got random event from poll for fd {fd}")
+					log_error(f"Got random event from epoll for fd {fd}")
 					continue
 
-				local_kind, connection_id, remote_socket = remote
-				_, _, local_socket = proxy_connections[remote_socket.fileno()]
+				local_kind, connection_id, remote_socket, local_hdr_tag, local_disconnect_hdr = remote
+				remote_kind, _, local_socket, _, remote_disconnect_hdr = proxy_connections[remote_socket.fileno()]
 
-				data, fds = msg_receive(local_socket)
+				try:
+					data, fds = msg_receive(local_socket)
+				except BlockingIOError:
+					# Nothing to read after all
+					continue
 				if not data:
 					del proxy_connections[local_socket.fileno()]
 					del proxy_connections[remote_socket.fileno()]
 
-					for sock, kind in (
-						(local_socket, local_kind),
-						(remote_socket, IS_CLIENT if local_kind == IS_SERVER else IS_SERVER)
+					for sock, kind, disconnect_hdr in (
+						(local_socket, local_kind, local_disconnect_hdr),
+						(remote_socket, remote_kind, remote_disconnect_hdr)
 					):
-						poll.unregister(sock)
+						ep.unregister(sock.fileno())
 						sock.close()
 						who = 'Server' if kind == IS_SERVER else 'Client'
 						log_info(f"{who}-{connection_id} disconnected")
 
-						sys.stdout.buffer.write(
-							struct.pack('=I', (0 << SIZE_LEFT_SHIFT) | (connection_id << 1) | kind)
-						)
+						if not discard_output:
+							stdout_iov.append(disconnect_hdr)
 
 					if REUSE_CONNECTION_IDS:
-						connection_ids_active.remove(connection_id)
+						connection_ids_free.append(connection_id)
 
-					if  len(proxy_connections) == 0:
+					if len(proxy_connections) == 0:
 						log_info("Last proxy client disconnected")
+						should_exit = True
 						break
-					else:
-						log_debug(f"Still {len(proxy_connections) // 2} connections alive")
-						continue
+					log_debug(f"Still {len(proxy_connections) // 2} connections alive")
+					continue
 
 				msg_send(data, fds, remote_socket)
 				if fds:
-					log_debug(f"Relayed {len(fds)} fd{'s' if len(fds) > 1 else ''}: {', '.join(str(x) for x in fds)}")
+					if LOG_LEVEL_MIN <= LOG_LEVEL_DEBUG:
+						log_debug(f"Relayed {len(fds)} fd{'s' if len(fds) > 1 else ''}: {', '.join(str(x) for x in fds)}")
 					for fd in fds:
-						log_debug(f"  closing fd {fd}")
+						if LOG_LEVEL_MIN <= LOG_LEVEL_DEBUG:
+							log_debug(f"  closing fd {fd}")
 						os.close(fd)
 
-				sys.stdout.buffer.write(
-					struct.pack('=I', (len(data) << SIZE_LEFT_SHIFT) | (connection_id << 1) | local_kind) + data
-				)
-				log_debug(f"[{connection_id}] Server -> Client {len(data):4d} bytes and {len(fds)} fds")
-			else:
-				continue
-			# we had a break before
-			break
+				if not discard_output:
+					# Header and data are handed to writev() as separate buffers
+					# to save concatenating them into yet another bytes object
+					stdout_iov.append(_HDR.pack((len(data) << SIZE_LEFT_SHIFT) | local_hdr_tag))
+					stdout_iov.append(data)
+					if len(stdout_iov) >= IOV_MAX:
+						writev_all(STDOUT_FILENO, stdout_iov)
+				if LOG_LEVEL_MIN <= LOG_LEVEL_DEBUG:
+					log_debug(f"[{connection_id}] Server -> Client {len(data):4d} bytes and {len(fds)} fds")
+			if should_exit:
+				break
 	except Exception as e:
 		log_error(f"Got unhandled exception: {type(e).__name__}: {e}")
 		err = traceback.format_exc()
@@ -372,7 +458,7 @@ if __name__ == '__main__':
 			log_error(line)
 	finally:
 		log_debug("Cleaning up")
-		sys.stdout.buffer.flush()
+		writev_all(STDOUT_FILENO, stdout_iov)
 		os.unlink(wayland_proxy_addr)
 		if child_proc is not None:
 			log_debug("Creating zombies")
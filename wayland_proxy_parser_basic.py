@@ -40,25 +40,54 @@ def log_warning(msg):
 def log_error(msg):
 	return _log(LOG_LEVEL_ERROR, msg)
 
-def wayland_parse(data, conv):
-	while len(data) >= 8:
-		oid, sizeop = struct.unpack(f'{conv}II', data[:8])
+# Turn disabled log levels into no-ops so they don't even reach _log()
+if LOG_LEVEL_MIN > LOG_LEVEL_DEBUG:
+	log_debug = lambda msg: None
+if LOG_LEVEL_MIN > LOG_LEVEL_INFO:
+	log_info = lambda msg: None
+if LOG_LEVEL_MIN > LOG_LEVEL_WARNING:
+	log_warn = log_warning = lambda msg: None
+
+_U_II_LE = struct.Struct('<II').unpack_from
+_U_II_BE = struct.Struct('>II').unpack_from
+_U_I_LE = struct.Struct('<I').unpack_from
+_U_I_BE = struct.Struct('>I').unpack_from
+_U_HH_LE = struct.Struct('<HH').unpack_from
+_U_HH_BE = struct.Struct('>HH').unpack_from
+
+def wayland_parse(buf, offset):
+	# Walk buf by offset instead of slicing off each parsed message,
+	# which would copy the remaining data every time. The last item
+	# yielded carries the offset of the first unparsed byte.
+	end = len(buf)
+	view = memoryview(buf)
+	while end - offset >= 8:
+		oid, sizeop = _U_II(buf, offset)
 		size = sizeop >> 16
 		op = sizeop & 0xffff
-		if len(data) < size:
-			yield None, None, data
-			return
-		argdata = data[8:size]
+		if end - offset < size:
+			break
+		argdata = view[offset + 8:offset + size].tobytes()
 		yield oid, op, argdata
-		data = data[size:]
-	yield None, None, data
+		offset += size
+	# buf can't be resized by the caller while the view exists
+	view.release()
+	yield None, None, offset
+
+# Parsed data is only dropped from the leftover buffer once
+# it has been consumed completely or grows larger than this.
+LEFTOVER_COMPACT_SIZE = 64 * 1024
 
 ENDIAN_MAGIC = 0x01020304
 IS_CLIENT, IS_SERVER = range(2)
 
 magic = sys.stdin.buffer.read(4)
-for conv in ('<', '>'):
-	val = struct.unpack(f'{conv}I', magic)[0]
+# Pick the unpackers matching the endianess of the dump
+for _U_II, _U_I, _U_HH in (
+	(_U_II_LE, _U_I_LE, _U_HH_LE),
+	(_U_II_BE, _U_I_BE, _U_HH_BE)
+):
+	val = _U_I(magic, 0)[0]
 	if val == ENDIAN_MAGIC:
 		break
 else:
@@ -66,7 +95,7 @@ else:
 	sys.exit(1)
 
 config = sys.stdin.buffer.read(4)
-disk_format, SIZE_SHIFT = struct.unpack(f'{conv}HH', config)
+disk_format, SIZE_SHIFT = _U_HH(config, 0)
 if disk_format != 1:
 	log_error(f"No idea how to handle on disk format {disk_format}")
 	sys.exit(1)
@@ -80,7 +109,7 @@ while True:
 		log_debug("Got empty read")
 		break
 
-	size_src = struct.unpack(f'{conv}I', size_src)[0]
+	size_src = _U_I(size_src, 0)[0]
 	source = size_src & SOURCE_MASK
 	size = size_src >> SIZE_SHIFT
 	if source & IS_SERVER:
@@ -106,16 +135,22 @@ while True:
 	if source not in leftover:
 		log_info(f"[{src_name}] connected")
 		last_source = source
-		leftover[source] = b''
+		leftover[source] = (bytearray(), 0)
 
-	data = leftover[source] + data
-	for oid, op_or_ev, argdata in wayland_parse(data, conv):
+	buf, offset = leftover[source]
+	buf += data
+	for oid, op_or_ev, argdata in wayland_parse(buf, offset):
 		if oid is None:
-			leftover[source] = argdata
+			offset = argdata
 			break
 		if source != last_source and sys.stdout.isatty():
 			log_info(f"[{src_name}]")
 			last_source = source
 		log_info(f"{src_name if not sys.stdout.isatty() else ''}  oid {oid:10d} {src_action:>7s} {op_or_ev:2d} args {argdata}")
 
+	if offset == len(buf) or offset > LEFTOVER_COMPACT_SIZE:
+		del buf[:offset]
+		offset = 0
+	leftover[source] = (buf, offset)
+
 log_debug("Bye from parser")
@@ -14,17 +14,23 @@
 	And to debug all non base protocols do something like
 		./wayland_proxy_parse_xml.py '' ' (wl_|xdg_)'
 		(pay attention to the space in front of the ignore so it doesn't match zwl_, zxdg_, ..)
+
+	Filters are matched against the oid and interface.request / interface.event
+	part of a line only, the arguments are not taken into account.
 """
 
 import os
 import re
 import sys
+import copy
 import struct
-from io import BytesIO
+from functools import lru_cache
 
 from wayland_protocol import (
 	WaylandProtocol,
-	DuplicateInterfaceName
+	DuplicateInterfaceName,
+	Arg_new_id,
+	Arg_object
 )
 
 (
@@ -64,6 +70,14 @@ def log_warning(msg):
 def log_error(msg):
 	return _log(LOG_LEVEL_ERROR, msg)
 
+# Turn disabled log levels into no-ops so they don't even reach _log()
+if LOG_LEVEL_MIN > LOG_LEVEL_DEBUG:
+	log_debug = lambda msg: None
+if LOG_LEVEL_MIN > LOG_LEVEL_INFO:
+	log_info = lambda msg: None
+if LOG_LEVEL_MIN > LOG_LEVEL_WARNING:
+	log_warn = log_warning = lambda msg: None
+
 class NewObj:
 	def __init__(self, args):
 		if isinstance(args, tuple):
@@ -86,9 +100,16 @@ class UnknownOpOrEvent:
 	def __repr__(self):
 		return self.name
 
+@lru_cache(maxsize=4096)
+def unknown_op_or_event(item):
+	return UnknownOpOrEvent(item)
+
 class _RawReturn:
 	def __getitem__(self, item):
-		return UnknownOpOrEvent(item)
+		return unknown_op_or_event(item)
+	def __len__(self):
+		# Makes the bounds check in the parser loop fall back to raw_return
+		return 0
 
 raw_return = _RawReturn()
 
@@ -106,16 +127,29 @@ class UnknownInterface:
 	def __str__(self):
 		return self.name
 
+@lru_cache(maxsize=4096)
+def unknown_interface(oid):
+	# Never modified, so it can be shared between objects and connections
+	return UnknownInterface(oid=oid)
+
 class InterfaceInstance:
 	def __init__(self, oid, interface, version=None):
 		self.oid = oid
 		self.interface = interface
+		# Accessed for every message, so don't go through __getattr__
+		self.name = interface.name
+		self.requests_by_number = interface.requests_by_number
+		self.events_by_number = interface.events_by_number
 		if version is None:
 			self.version = interface.version
 		else:
 			self.version = version
 
 	def __getattr__(self, key):
+		if key.startswith('__'):
+			# Don't forward special methods, copy.deepcopy() looks for
+			# those before self.interface exists on the new instance.
+			raise AttributeError(key)
 		return getattr(self.interface, key)
 
 	def __str__(self):
@@ -151,11 +185,11 @@ class LookUps:
 	def get_object(self, oid):
 		object = self.objects.get(oid)
 		if object is None:
-			object = InterfaceInstance(oid, UnknownInterface(oid=oid))
+			object = InterfaceInstance(oid, unknown_interface(oid))
 			self.objects[oid] = object
 		return object
 
-def init_lookups():
+def parse_protocols():
 	lookups = LookUps()
 	for protocol_path in (
 		'protocols/wayland/protocol',
@@ -177,27 +211,58 @@ def init_lookups():
 	lookups.add_object(1, lookups.interfaces['wl_display'])
 	return lookups
 
-def wayland_parse(data, conv):
-	while len(data) >= 8:
-		oid, sizeop = struct.unpack(f'{conv}II', data[:8])
+lookups_template = None
+
+def init_lookups():
+	# Protocol XMLs are only parsed once. Every connection gets its own
+	# copy as globals, objects and interface versions are per connection.
+	global lookups_template
+	if lookups_template is None:
+		lookups_template = parse_protocols()
+	return copy.deepcopy(lookups_template)
+
+_U_II_LE = struct.Struct('<II').unpack_from
+_U_II_BE = struct.Struct('>II').unpack_from
+_U_I_LE = struct.Struct('<I').unpack_from
+_U_I_BE = struct.Struct('>I').unpack_from
+_U_HH_LE = struct.Struct('<HH').unpack_from
+_U_HH_BE = struct.Struct('>HH').unpack_from
+
+def wayland_parse(buf, offset):
+	# Walk buf by offset instead of slicing off each parsed message,
+	# which would copy the remaining data every time. The last item
+	# yielded carries the offset of the first unparsed byte.
+	end = len(buf)
+	view = memoryview(buf)
+	while end - offset >= 8:
+		oid, sizeop = _U_II(buf, offset)
 		# Read II instead of IHH because wayland seems
 		# to always write 4 bytes at once and thus
 		# args could be switched on endian differences.
 		size = sizeop >> 16
 		op = sizeop & 0xffff
-		if len(data) < size:
-			yield None, None, data
-			return
-		argdata = data[8:size]
+		if end - offset < size:
+			break
+		argdata = view[offset + 8:offset + size].tobytes()
 		yield oid, op, argdata
-		data = data[size:]
-	yield None, None, data
+		offset += size
+	# buf can't be resized by the caller while the view exists
+	view.release()
+	yield None, None, offset
+
+# Parsed data is only dropped from the leftover buffer once
+# it has been consumed completely or grows larger than this.
+LEFTOVER_COMPACT_SIZE = 64 * 1024
 
 ENDIAN_MAGIC = 0x01020304
 IS_CLIENT, IS_SERVER = range(2)
 magic = sys.stdin.buffer.read(4)
-for conv in ('<', '>'):
-	val = struct.unpack(f'{conv}I', magic)[0]
+# Pick the unpackers matching the endianess of the dump
+for _U_II, _U_I, _U_HH in (
+	(_U_II_LE, _U_I_LE, _U_HH_LE),
+	(_U_II_BE, _U_I_BE, _U_HH_BE)
+):
+	val = _U_I(magic, 0)[0]
 	if val == ENDIAN_MAGIC:
 		break
 else:
@@ -205,7 +270,7 @@ else:
 	sys.exit(1)
 
 config = sys.stdin.buffer.read(4)
-disk_format, SIZE_SHIFT = struct.unpack(f'{conv}HH', config)
+disk_format, SIZE_SHIFT = _U_HH(config, 0)
 if disk_format != 1:
 	log_error(f"No idea how to handle on disk format {disk_format}")
 	sys.exit(1)
@@ -221,6 +286,14 @@ if len(sys.argv) > 2:
 else:
 	re_ignore = None
 
+if re_filter is None and re_ignore is None:
+	line_matches = lambda line: True
+else:
+	def line_matches(line):
+		return re_filter.search(line) and not (
+			re_ignore and re_ignore.search(line)
+		)
+
 connections = dict()
 last_source = None
 leftover = dict()
@@ -230,7 +303,7 @@ while True:
 		log_debug("Got empty read")
 		break
 
-	size_src = struct.unpack(f'{conv}I', size_src)[0]
+	size_src = _U_I(size_src, 0)[0]
 	source = size_src & SOURCE_MASK
 	connection_id = source >> 1
 	size = size_src >> SIZE_SHIFT
@@ -262,40 +335,48 @@ while True:
 
 	if source not in leftover:
 		log_info(f"[{src_name}] connected")
-		leftover[source] = b''
+		leftover[source] = (bytearray(), 0)
 		last_source = source
 
-	data = leftover[source] + data
-	for oid, op_or_ev, argdata in wayland_parse(data, conv):
+	buf, offset = leftover[source]
+	buf += data
+	for oid, op_or_ev, argdata in wayland_parse(buf, offset):
 		if oid is None:
-			leftover[source] = argdata
+			offset = argdata
 			break
-		log_debug(f"  oid {oid:10d} {src_action:>7s} {op_or_ev:2d} args {argdata}")
+		if LOG_LEVEL_MIN <= LOG_LEVEL_DEBUG:
+			log_debug(f"  oid {oid:10d} {src_action:>7s} {op_or_ev:2d} args {argdata}")
 		obj = lookups.get_object(oid)
 		if source & IS_SERVER:
 			op_or_ev_by_number = obj.events_by_number
 		else:
 			op_or_ev_by_number = obj.requests_by_number
-		op_or_event = op_or_ev_by_number[op_or_ev]
+		if op_or_ev < len(op_or_ev_by_number):
+			op_or_event = op_or_ev_by_number[op_or_ev]
+		else:
+			op_or_event = raw_return[op_or_ev]
 
-		args = list()
 		args_plain = list()
 		new_obj = None
 		if isinstance(op_or_event, UnknownOpOrEvent):
-			log_debug(f"Unknown {src_action}")
+			if LOG_LEVEL_MIN <= LOG_LEVEL_DEBUG:
+				log_debug(f"Unknown {src_action}")
 			args_plain.append(argdata)
 		else:
-			argdata_stream = BytesIO(argdata)
-			args = op_or_event.args.copy()
-			for arg in args:
-				log_debug(f"Got arg {arg} with name {arg.__class__.__name__}")
+			# Args unmarshal straight from argdata at the given offset
+			arg_offset = 0
+			for arg in op_or_event.args:
+				if LOG_LEVEL_MIN <= LOG_LEVEL_DEBUG:
+					log_debug(f"Got arg {arg} with name {arg.__class__.__name__}")
 				try:
-					arg_plain = arg.unmarshal(argdata_stream, list(range(5)))
-					log_debug(f"Got arg plain {arg_plain}")
-					if arg.__class__.__name__ == 'Arg_new_id':
+					arg_plain, arg_offset = arg.unmarshal_from(argdata, arg_offset, list(range(5)))
+					if LOG_LEVEL_MIN <= LOG_LEVEL_DEBUG:
+						log_debug(f"Got arg plain {arg_plain}")
+					arg_type = type(arg)
+					if arg_type is Arg_new_id:
 						new_obj = NewObj(arg_plain)
 						args_plain.append(new_obj)
-					elif arg.__class__.__name__ == 'Arg_object':
+					elif arg_type is Arg_object:
 						args_plain.append(lookups.get_object(arg_plain))
 					else:
 						args_plain.append(arg_plain)
@@ -329,23 +410,25 @@ while True:
 				lookups.add_object(new_obj.oid, interface, new_obj.version)
 				log_debug(f"New object is of type {lookups.get_object(new_obj.oid)}")
 
-		line = "{}  {:^10d} {}.{}({})".format(
+		# Only format the args once the line passed the filters
+		line = "{}  {:^10d} {}.{}".format(
 			src_name if not sys.stdout.isatty() else '',
-			oid, obj.name, op_or_event.name,
-			", ".join(
+			oid, obj.name, op_or_event.name
+		)
+		if line_matches(line):
+			line = "{}({})".format(line, ", ".join(
 				(f"'{x}'" if isinstance(x, str) and not x.startswith('<oid ') else str(x))
 				for x in args_plain
-			)
-		)
-		if not re_filter or (
-			re_filter.search(line) and not (
-				re_ignore and re_ignore.search(line)
-			)
-		):
+			))
 			if source != last_source and sys.stdout.isatty():
 				log_info(f"[{src_name}]")
 				last_source = source
 			log_info(line)
 
+	if offset == len(buf) or offset > LEFTOVER_COMPACT_SIZE:
+		del buf[:offset]
+		offset = 0
+	leftover[source] = (buf, offset)
+
 
 log_debug("Bye from parser")